@@ -1,43 +1,102 @@
 """Support Peewee ORM with asyncio."""
 
+import os
 import typing as t
 from collections import deque
 from contextvars import ContextVar
-from inspect import isawaitable
+from weakref import WeakKeyDictionary
 
 import peewee as pw
 from playhouse import db_url, pool, cockroachdb as crdb
 from playhouse.postgres_ext import PostgresqlExtDatabase
 from playhouse.sqlite_ext import SqliteExtDatabase
 
-from .transactions import _transaction_async, _atomic_async, _savepoint_async, _manual_async
-from ._compat import aio_wait, aio_sleep, aio_event, FIRST_COMPLETED
+from .transactions import (
+    _transaction_async, _transaction_sqlite_async, _atomic_async, _savepoint_async, _manual_async)
+from ._compat import aio_backend, aio_event, aio_lock, aio_loop, aio_timeout
 
 
 __version__ = "0.4.1"
 
-_ctx: t.Dict[str, ContextVar] = {
-    'closed': ContextVar('closed', default=True),
-    'conn': ContextVar('conn', default=None),
-    'ctx': ContextVar('ctx', default=None),
-    'transactions': ContextVar('transactions', default=None),
-}
 
+class _State:
+    """Connection state of a task.
 
-class _AsyncConnectionState(pw._ConnectionState):
+    The default state (empty tuples) is shared, it is replaced on reset/connect before peewee
+    starts to mutate the stacks.
+    """
+
+    __slots__ = 'closed', 'conn', 'ctx', 'transactions'
+
+    def __init__(self, closed: bool = True, conn: t.Any = None,
+                 ctx: t.Sequence = (), transactions: t.Sequence = ()):
+        self.closed = closed
+        self.conn = conn
+        self.ctx = ctx
+        self.transactions = transactions
+
+
+_state: ContextVar[_State] = ContextVar('state', default=_State())
+
+
+class _AsyncConnectionState:
+    """Keep the connection state in a context variable.
+
+    The state object is rebound only on reset/connect, so a task never changes the state of
+    its parent and the rest of the accesses are plain slot lookups. The class implements
+    peewee's ``_ConnectionState`` interface without inheriting it, so it has no instance dict.
+    """
+
+    __slots__ = ()
+
+    def __init__(self):
+        _state.set(_State(True, None, [], []))
+
+    def reset(self):
+        state = _state.get()
+        # Peewee resets the state before every connect, skip it when the state is clean
+        if state.conn is None and state.closed and not (state.ctx or state.transactions):
+            return
+
+        _state.set(_State(True, None, [], []))
+
+    def set_connection(self, conn: t.Any):
+        _state.set(_State(False, conn, [], []))
 
     def __setattr__(self, name: str, value: t.Any):
-        _ctx[name].set(value)
+        setattr(_state.get(), name, value)
 
     def __getattr__(self, name: str) -> t.Any:
-        return _ctx[name].get()
+        return getattr(_state.get(), name)
+
+
+class _ConnectionContextAsync(pw.ConnectionContext):
+    """Open a connection (if closed) for the context, close it on exit.
+
+    A connection which has been opened before (it may be inherited from a parent task) is
+    kept opened.
+    """
+
+    __slots__ = ('opened',)
+
+    async def __aenter__(self):
+        """Enter to async context."""
+        self.opened = self.db._state.closed
+        return await self.db.connect_async(reuse_if_open=True)
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        """Exit from async context."""
+        if self.opened:
+            await self.db.close_async()
 
 
 class DatabaseAsync:
     """Base interface for async databases."""
 
     if t.TYPE_CHECKING:
+        atomic: t.Callable
         connect: t.Callable
+        execute_sql: t.Callable
 
     def init(self, database: str, **kwargs):
         """Initialize the state."""
@@ -46,6 +105,9 @@ class DatabaseAsync:
 
     async def connect_async(self, reuse_if_open: bool = False) -> t.Any:
         """For purposes of compatability."""
+        if reuse_if_open and not self._state.closed:
+            return self._state.conn
+
         self.connect(reuse_if_open=reuse_if_open)
         return self._state.conn
 
@@ -56,6 +118,56 @@ class DatabaseAsync:
 
         self.close()
 
+    async def executemany_async(self, sql: str, rows: t.Iterable, chunk: int = 249) -> int:
+        """Run the given statement for every row in a single transaction.
+
+        Use it for bulk inserts when the rows are already prepared: unlike ``insert_many`` the
+        rows skip peewee's field conversion. The SQL must use the driver's paramstyle.
+        A connection opened by the call is closed after it. Return the number of the affected
+        rows.
+        """
+        count = 0
+        opened = self._state.closed
+        await self.connect_async(reuse_if_open=True)
+        try:
+            with self.atomic(), pw.__exception_wrapper__:
+                cursor = self.cursor()
+                try:
+                    for batch in pw.chunked(rows, chunk):
+                        pw.logger.debug((sql, batch))
+                        cursor.executemany(sql, batch)
+                        count += cursor.rowcount
+
+                finally:
+                    cursor.close()
+
+        finally:
+            if opened:
+                await self.close_async()
+
+        return count
+
+    def cursor(self, commit: t.Any = None, named_cursor: t.Any = None) -> t.Any:
+        """Resolve the task's connection state once per query."""
+        state = _state.get()
+        if state.closed or commit is not None or named_cursor:
+            return super(DatabaseAsync, self).cursor(commit, named_cursor)  # type: ignore
+
+        return state.conn.cursor()
+
+    def execute_scalar(self, sql: str, params: t.Optional[t.Sequence] = None) -> t.Any:
+        """Run the query and return the first column of the first row (or None)."""
+        cursor = self.execute_sql(sql, params)
+        try:
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+
+        return row[0] if row else None
+
+    def connection_context_async(self):
+        return _ConnectionContextAsync(self)
+
     def transaction_async(self, *args, **kwargs):
         return _transaction_async(self, *args, **kwargs)
 
@@ -70,8 +182,17 @@ class DatabaseAsync:
 
     async def __aenter__(self):
         """Enter to async context."""
-        conn = await self.connect_async(reuse_if_open=True)
-        super().__enter__()
+        state = _state.get()
+        if state.closed:
+            conn = await self.connect_async()
+
+        # Reuse the connection (it may be inherited from a parent task), but copy the stacks,
+        # so the task doesn't pop (and close) the contexts of others
+        else:
+            conn = state.conn
+            _state.set(_State(False, conn, list(state.ctx), list(state.transactions)))
+
+        self.__enter__()
         return conn
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
@@ -95,51 +216,85 @@ class PooledDatabaseAsync(DatabaseAsync):
         is_closed: t.Callable[..., bool]
 
     def init(self, database: str, **kwargs):
-        """Prepare the limiter."""
+        """Prepare the limiter.
+
+        :param fair: Serve the waiters in FIFO order (default). With ``fair=False`` the most
+            recently parked waiter is woken first (LIFO) and new tasks may take a free slot
+            before the waiters. That lowers the latency for most of the tasks under load,
+            but the oldest waiters may starve until they time out.
+        """
+        self._fair = kwargs.pop('fair', True)
         self._waiters: t.Deque = deque()
+        self._handoffs = 0
         super(PooledDatabaseAsync, self).init(database, **kwargs)
 
     async def connect_async(self, reuse_if_open: bool = False) -> t.Any:
-        """Catch a connection asyncrounosly."""
-        if reuse_if_open and not self.is_closed():
-            return self._state.conn
+        """Catch a connection asyncrounosly.
 
-        if len(self._in_use) >= self._max_connections:
-            waiter = aio_event()
-            self._waiters.append(waiter)
-            try:
-                await aio_wait(
-                    waiter.wait(),
-                    _raise_timeout(self._wait_timeout),
-                    strategy=FIRST_COMPLETED,
-                )
+        A freed slot is reserved for the woken waiter, so new tasks cannot take it over before
+        the waiter wakes up.
+        """
+        if reuse_if_open and not self._state.closed:
+            return self._state.conn
 
-            except TimeoutError:
-                raise pool.MaxConnectionsExceeded(
-                    'Max connections exceeded, timed out attempting to connect.')
+        try:
+            if (self._fair and self._waiters) or \
+                    len(self._in_use) + self._handoffs >= self._max_connections:
+                waiter = aio_event()
+                self._waiters.append(waiter)
+                try:
+                    await self._release()
+                    await aio_timeout(waiter.wait(), self._wait_timeout)
+
+                except TimeoutError:
+                    if not waiter.is_set():
+                        raise pool.MaxConnectionsExceeded(
+                            'Max connections exceeded, timed out attempting to connect.')
+
+                finally:
+                    if waiter.is_set():
+                        self._handoffs -= 1
+                    else:
+                        self._waiters.remove(waiter)
+
+            # Skip PooledDatabase.connect, it polls with time.sleep() when the pool is exhausted
+            super(pool.PooledDatabase, self).connect(reuse_if_open=reuse_if_open)
+
+        # The task has not taken the slot (it may be handed over to it and the task has been
+        # cancelled or the connect failed), pass the slot to the next waiter
+        except BaseException:
+            if self._waiters:
+                await self._release()
+            raise
 
-        self.connect(reuse_if_open=reuse_if_open)
         return self._state.conn
 
-    async def _release(self):
-        for _ in range(self._max_connections - len(self._in_use)):
-            if not self._waiters:
-                break
-            waiter = self._waiters.popleft()
-            coro = waiter.set()
-            if coro and isawaitable(coro):
-                await coro
+    async def _release(self, free: t.Optional[int] = None):
+        """Hand the free slots over to the waiters."""
+        if free is None:
+            free = self._max_connections - len(self._in_use) - self._handoffs
+
+        pop = self._waiters.popleft if self._fair else self._waiters.pop
+        set_async = aio_backend() == 'curio'  # only curio's Event.set is a coroutine
+        while free > 0 and self._waiters:
+            waiter = pop()
+            self._handoffs += 1
+            free -= 1
+            if set_async:
+                await waiter.set()
+            else:
+                waiter.set()
 
     async def close_all_async(self):
-        while self._waiters:
-            super(PooledDatabaseAsync, self).close_all()
-            await self._release()
+        self.close_all()
+        await self._release(len(self._waiters))
 
     async def close_async(self):
         if self.in_transaction():
             raise pw.OperationalError('Attempting to close database while transaction is open.')
-        super(PooledDatabaseAsync, self).close()
-        await self._release()
+        self.close()
+        if self._waiters:
+            await self._release()
 
 
 class PostgresqlDatabaseAsync(DatabaseAsync, pw.PostgresqlDatabase):
@@ -158,19 +313,74 @@ class PooledPostgresqlExtDatabaseAsync(PooledDatabaseAsync, pool.PooledPostgresq
     pass
 
 
-class SqliteDatabaseAsync(DatabaseAsync, pw.SqliteDatabase):
+class _SqliteDatabaseAsync:
+    """Tune SQLite for concurrent access.
+
+    File databases use the WAL journal (readers don't block writers) with a lighter sync.
+    The pragmas given to the database take precedence over the defaults.
+
+    Async transactions begin with ``BEGIN IMMEDIATE`` (a transaction which starts reading
+    cannot fail to upgrade to a writer later) and the tasks run them one by one.
+    """
+
+    default_pragmas = (
+        ('journal_mode', 'wal'),
+        ('synchronous', 'normal'),
+        ('temp_store', 'memory'),
+    )
+
+    if t.TYPE_CHECKING:
+        _pragmas: t.List
+        _write_locks: WeakKeyDictionary
+        database: t.Union[str, os.PathLike]
+
+    def init(self, database: str, **kwargs):
+        """Add the default pragmas."""
+        super(_SqliteDatabaseAsync, self).init(database, **kwargs)  # type: ignore
+        self._write_locks = WeakKeyDictionary()
+        if database and ':memory:' not in os.fspath(database):
+            self._pragmas = list(dict(self.default_pragmas, **dict(self._pragmas)).items())
+
+    def _set_pragmas(self, conn):
+        """Run the pragmas as a single script."""
+        conn.executescript(''.join(
+            'PRAGMA %s = %s;' % (pragma, value) for pragma, value in self._pragmas))
+
+    def transaction_async(self, lock_type: t.Optional[str] = 'IMMEDIATE'):
+        return _transaction_sqlite_async(self, lock_type)
+
+    def _get_write_lock(self, lock_type: t.Optional[str] = None):
+        """Get the lock for the transaction (in-memory databases are not shared).
+
+        The locks are bound to the running loops, the database may outlive them.
+        """
+        if not lock_type or lock_type.upper() == 'DEFERRED' or \
+                ':memory:' in os.fspath(self.database):
+            return None
+
+        loop = aio_loop()
+        lock = self._write_locks.get(loop)
+        if lock is None:
+            lock = self._write_locks[loop] = aio_lock()
+
+        return lock
+
+
+class SqliteDatabaseAsync(_SqliteDatabaseAsync, DatabaseAsync, pw.SqliteDatabase):
     pass
 
 
-class PooledSqliteDatabaseAsync(PooledDatabaseAsync, pool.PooledSqliteDatabase):
+class PooledSqliteDatabaseAsync(
+        _SqliteDatabaseAsync, PooledDatabaseAsync, pool.PooledSqliteDatabase):
     pass
 
 
-class SqliteExtDatabaseAsync(DatabaseAsync, SqliteExtDatabase):
+class SqliteExtDatabaseAsync(_SqliteDatabaseAsync, DatabaseAsync, SqliteExtDatabase):
     pass
 
 
-class PooledSqliteExtDatabaseAsync(PooledDatabaseAsync, pool.PooledSqliteExtDatabase):
+class PooledSqliteExtDatabaseAsync(
+        _SqliteDatabaseAsync, PooledDatabaseAsync, pool.PooledSqliteExtDatabase):
     pass
 
 
@@ -190,18 +400,26 @@ class PooledCockroachDatabaseAsync(PooledDatabaseAsync, crdb.PooledCockroachData
     pass
 
 
-db_url.schemes['cockroachdb+async'] = db_url.schemes['crdb+async'] = CockroachDatabaseAsync
-db_url.schemes['cockroachdb+pool+async'] = db_url.schemes['crdb+pool+async'] = PooledCockroachDatabaseAsync  # noqa
-db_url.schemes['mysql+async'] = MySQLDatabaseAsync
-db_url.schemes['mysql+pool+async'] = PooledMySQLDatabaseAsync
-db_url.schemes['postgres+async'] = db_url.schemes['postgresql+async'] = PostgresqlDatabaseAsync
-db_url.schemes['postgresext+async'] = db_url.schemes['postgresqlext+async'] = PostgresqlExtDatabaseAsync
-db_url.schemes['postgres+pool+async'] = db_url.schemes['postgresql+pool+async'] = PooledPostgresqlDatabaseAsync  # noqa
-db_url.schemes['postgresext+pool+async'] = db_url.schemes['postgresqlext+pool+async'] = PooledPostgresqlExtDatabaseAsync  # noqa
-db_url.schemes['sqlite+async'] = SqliteDatabaseAsync
-db_url.schemes['sqlite+pool+async'] = PooledSqliteDatabaseAsync
-db_url.schemes['sqliteext+async'] = SqliteExtDatabaseAsync
-db_url.schemes['sqliteext+pool+async'] = PooledSqliteExtDatabaseAsync
+db_url.schemes.update({
+    'cockroachdb+async': CockroachDatabaseAsync,
+    'crdb+async': CockroachDatabaseAsync,
+    'cockroachdb+pool+async': PooledCockroachDatabaseAsync,
+    'crdb+pool+async': PooledCockroachDatabaseAsync,
+    'mysql+async': MySQLDatabaseAsync,
+    'mysql+pool+async': PooledMySQLDatabaseAsync,
+    'postgres+async': PostgresqlDatabaseAsync,
+    'postgresql+async': PostgresqlDatabaseAsync,
+    'postgresext+async': PostgresqlExtDatabaseAsync,
+    'postgresqlext+async': PostgresqlExtDatabaseAsync,
+    'postgres+pool+async': PooledPostgresqlDatabaseAsync,
+    'postgresql+pool+async': PooledPostgresqlDatabaseAsync,
+    'postgresext+pool+async': PooledPostgresqlExtDatabaseAsync,
+    'postgresqlext+pool+async': PooledPostgresqlExtDatabaseAsync,
+    'sqlite+async': SqliteDatabaseAsync,
+    'sqlite+pool+async': PooledSqliteDatabaseAsync,
+    'sqliteext+async': SqliteExtDatabaseAsync,
+    'sqliteext+pool+async': PooledSqliteExtDatabaseAsync,
+})
 
 
 class PeeweeASGIPlugin:
@@ -210,6 +428,7 @@ class PeeweeASGIPlugin:
     defaults = {
         'url': 'sqlite+async:///db.sqlite',
         'connection_params': {},
+        'lazy': False,
     }
 
     def __init__(self, **options):
@@ -220,42 +439,74 @@ class PeeweeASGIPlugin:
             self.config['url'], **self.config['connection_params'])
 
     def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
         return getattr(self.database, name)
 
     async def shutdown(self):
         """Shutdown the database."""
-        if hasattr(self.database, 'close_all'):
-            self.database.close_all()
+        database = self.database
+        if isinstance(database, PooledDatabaseAsync):
+            await database.close_all_async()
+
+        elif hasattr(database, 'close_all'):
+            database.close_all()
 
     def middleware(self, app):
-        """Manage DB connections."""
+        """Manage DB connections.
+
+        With the ``lazy`` option a connection is opened by the first query (peewee's
+        autoconnect) instead of on every request, so requests which don't touch the database
+        skip the connect/close round trip. Pooled databases always connect on the request, to
+        wait for a free connection asynchronously.
+        """
+        database = self.database
+        connect, close = database.connect_async, database.close_async
+
+        if self.config['lazy'] and not isinstance(database, PooledDatabaseAsync):
+
+            async def process_lazy(scope, receive, send):
+                try:
+                    return await app(scope, receive, send)
+
+                finally:
+                    if not database._state.closed:
+                        await close()
+
+            return process_lazy
 
         async def process(scope, receive, send):
             try:
-                await self.database.connect_async()
+                await connect()
                 return await app(scope, receive, send)
 
             finally:
-                await self.database.close_async()
+                await close()
 
         return process
 
     def register(self, cls):
         """A decorator to register models with the plugin."""
-        if issubclass(cls, pw.Model):
+        if pw.Model in cls.__mro__:
             self.models[cls._meta.table_name] = cls
 
         cls._meta.database = self.database
         return cls
 
     def create_tables(self, **options):
-        """Create tables for the registered models."""
-        for model in self.models.values():
-            model.create_table(**options)
+        """Create tables for the registered models in a single transaction."""
+        database = self.database
+        opened = database.is_closed()
+        if opened:
+            database.connect()
 
+        try:
+            with database.atomic():
+                database.create_tables(list(self.models.values()), **options)
 
-async def _raise_timeout(timeout: t.Union[int, float]):
-    await aio_sleep(timeout)
-    raise TimeoutError('Timeout occuirs.')
+        finally:
+            if opened:
+                database.close()
 
 # pylama: ignore=D,E501
@@ -1,39 +1,41 @@
 import typing as t
 from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED
-import sys
-from inspect import iscoroutine
+from contextvars import ContextVar
 import asyncio
 
 from sniffio import current_async_library
 
-try:
-    import trio
+# trio and curio are imported inside the helpers: they are only used when the library is
+# running (so it is already in sys.modules), asyncio-only applications never import them.
 
-except ImportError:
-    trio = None
+INF = float('inf')
 
-# Python 3.8+
-if sys.version_info >= (3, 8):
-    create_task = asyncio.create_task
+_backend: ContextVar[t.Optional[str]] = ContextVar('backend', default=None)
 
-# Python 3.7
-else:
-    create_task = asyncio.ensure_future
 
+def aio_backend() -> str:
+    """Return the current async library (cached for the current context).
 
-try:
-    import curio
+    The helpers below resolve the library once per call and dispatch on it. The result is not
+    cached process-wide: a process may run several libraries (e.g. the tests).
+    """
+    backend = _backend.get()
+    if backend is None:
+        backend = current_async_library()
+        _backend.set(backend)
 
-except ImportError:
-    curio = None
+    return backend
 
 
 def aio_sleep(seconds: float = 0) -> t.Awaitable:
     """Return sleep coroutine."""
-    if trio and current_async_library() == 'trio':
+    backend = aio_backend()
+    if backend == 'trio':
+        import trio
         return trio.sleep(seconds)
 
-    if curio and current_async_library() == 'curio':
+    if backend == 'curio':
+        import curio
         return curio.sleep(seconds)
 
     return asyncio.sleep(seconds)
@@ -41,55 +43,133 @@ def aio_sleep(seconds: float = 0) -> t.Awaitable:
 
 def aio_event():
     """Create async event."""
-    if trio and current_async_library() == 'trio':
+    backend = aio_backend()
+    if backend == 'trio':
+        import trio
         return trio.Event()
 
-    if curio and current_async_library() == 'curio':
+    if backend == 'curio':
+        import curio
         return curio.Event()
 
     return asyncio.Event()
 
 
-async def aio_wait(*aws: t.Awaitable, strategy: str = ALL_COMPLETED) -> t.Any:
+def aio_loop() -> t.Any:
+    """Return the running loop (the key for the primitives bound to it)."""
+    backend = aio_backend()
+    if backend == 'trio':
+        import trio
+        return trio.lowlevel.current_trio_token()
+
+    # Curio's primitives are not bound to a kernel
+    if backend == 'curio':
+        import curio
+        return curio
+
+    return asyncio.get_running_loop()
+
+
+def aio_lock():
+    """Create async lock."""
+    backend = aio_backend()
+    if backend == 'trio':
+        import trio
+        return trio.Lock()
+
+    if backend == 'curio':
+        import curio
+        return curio.Lock()
+
+    return asyncio.Lock()
+
+
+async def aio_timeout(aw: t.Awaitable, timeout: t.Optional[float]) -> t.Any:
+    """Wait for the awaitable, raise TimeoutError if it takes longer than the timeout.
+
+    Wait forever when the timeout is None or infinite.
+    """
+    if timeout is None or timeout == INF:
+        return await aw
+
+    backend = aio_backend()
+    if backend == 'trio':
+        import trio
+        try:
+            with trio.fail_after(timeout):
+                return await aw
+
+        except trio.TooSlowError:
+            raise TimeoutError('Timeout occuirs.')
+
+    if backend == 'curio':
+        import curio
+        try:
+            return await curio.timeout_after(timeout, aw)
+
+        except curio.TaskTimeout:
+            raise TimeoutError('Timeout occuirs.')
+
+    try:
+        return await asyncio.wait_for(aw, timeout)
+
+    except asyncio.TimeoutError:
+        raise TimeoutError('Timeout occuirs.')
+
+
+async def aio_wait(*aws: t.Coroutine, strategy: str = ALL_COMPLETED) -> t.Any:
     """Run the coros concurently, wait for all completed or cancel others.
 
-    Only ALL_COMPLETED, FIRST_COMPLETED are supported.
+    Only coroutines are accepted (curio spawns them as tasks anyway).
+    Only ALL_COMPLETED, FIRST_COMPLETED are supported. The results of ALL_COMPLETED are in the
+    order of the coroutines.
     """
     if not aws:
         return
 
-    if trio and current_async_library() == 'trio':
+    if len(aws) == 1:
+        result = await aws[0]
+        return [result] if strategy == ALL_COMPLETED else result
 
-        send_channel, receive_channel = trio.open_memory_channel(0)
+    backend = aio_backend()
+    if backend == 'trio':
+        import trio
+        results: t.List = [None] * len(aws)
+        completed: t.List[int] = []
 
         async with trio.open_nursery() as n:
-            [n.start_soon(trio_jockey, aw, send_channel) for aw in aws]
-            results = []
-            for _ in aws:
-                results.append(await receive_channel.receive())
+
+            async def run(idx: int, aw: t.Coroutine):
+                results[idx] = await aw
+                completed.append(idx)
                 if strategy == FIRST_COMPLETED:
                     n.cancel_scope.cancel()
-                    return results[0]
 
-            return results
+            [n.start_soon(run, idx, aw) for idx, aw in enumerate(aws)]
+
+        return results if strategy == ALL_COMPLETED else results[completed[0]]
 
-    if curio and current_async_library() == 'curio':
+    if backend == 'curio':
+        import curio
         wait = all if strategy == ALL_COMPLETED else any
         async with curio.TaskGroup(wait=wait) as g:
             [await g.spawn(aw) for aw in aws]
 
         return g.results if strategy == ALL_COMPLETED else g.result
 
-    aws = tuple(create_task(aw) if iscoroutine(aw) else aw for aw in aws)
-    done, pending = await asyncio.wait(aws, return_when=strategy)
-    if strategy != ALL_COMPLETED:
-        [task.cancel() for task in pending]
-        await asyncio.gather(*pending, return_exceptions=True)
-        return list(done)[0].result()
-
-    return [t.result() for t in done]
-
-
-async def trio_jockey(coro: t.Awaitable, channel):
-    """Wait for the given coroutine and send result back to the given channel."""
-    await channel.send(await coro)
+    loop = asyncio.get_running_loop()
+    tasks = [loop.create_task(aw) for aw in aws]
+    if strategy == ALL_COMPLETED:
+        try:
+            return await asyncio.gather(*tasks)
+
+        # Cancel the others on error (as trio's nursery and curio's task group do)
+        except BaseException:
+            [task.cancel() for task in tasks]
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    done, pending = await asyncio.wait(tasks, return_when=strategy)
+    [task.cancel() for task in pending]
+    await asyncio.gather(*pending, return_exceptions=True)
+    return list(done)[0].result()
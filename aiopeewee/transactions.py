@@ -7,46 +7,78 @@ class _transaction_async(pw._transaction):
 
     async def __aenter__(self):
         """Enter to async context."""
-        return super().__enter__()
+        return pw._transaction.__enter__(self)
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         """Exit from async context."""
-        return super().__exit__(exc_type, exc_val, exc_tb)
+        return pw._transaction.__exit__(self, exc_type, exc_val, exc_tb)
+
+
+class _transaction_sqlite_async(_transaction_async):
+    """Run the write transactions of the database one by one.
+
+    The tasks wait for the lock instead of blocking the event loop in SQLite's busy handler
+    (while the task which holds the database lock cannot run).
+    """
+
+    async def __aenter__(self):
+        """Enter to async context."""
+        # Nested transactions are flattened (no BEGIN), the lock is held by the outer one
+        self._lock = lock = None if self.db.transaction_depth() else \
+            self.db._get_write_lock(*self._begin_args[0], **self._begin_args[1])
+        if lock is None:
+            return pw._transaction.__enter__(self)
+
+        await lock.__aenter__()
+        try:
+            return pw._transaction.__enter__(self)
+        except BaseException:
+            await lock.__aexit__(None, None, None)
+            raise
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        """Exit from async context."""
+        try:
+            return pw._transaction.__exit__(self, exc_type, exc_val, exc_tb)
+        finally:
+            if self._lock is not None:
+                await self._lock.__aexit__(None, None, None)
 
 
 class _savepoint_async(pw._savepoint):
 
     async def __aenter__(self):
         """Enter to async context."""
-        return super().__enter__()
+        return pw._savepoint.__enter__(self)
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         """Exit from async context."""
-        return super().__exit__(exc_type, exc_val, exc_tb)
+        return pw._savepoint.__exit__(self, exc_type, exc_val, exc_tb)
 
 
 class _manual_async(pw._manual):
 
     async def __aenter__(self):
         """Enter to async context."""
-        return super().__enter__()
+        return pw._manual.__enter__(self)
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         """Exit from async context."""
-        return super().__exit__(exc_type, exc_val, exc_tb)
+        return pw._manual.__exit__(self, exc_type, exc_val, exc_tb)
 
 
 class _atomic_async(pw._atomic):
 
     async def __aenter__(self):
         """Enter to async context."""
-        if self.db.transaction_depth() == 0:
+        db = self.db
+        if db.transaction_depth() == 0:
             args, kwargs = self._transaction_args
-            self._helper = self.db.transaction_async(*args, **kwargs)
-        elif isinstance(self.db.top_transaction(), pw._manual):
+            self._helper = db.transaction_async(*args, **kwargs)
+        elif isinstance(db.top_transaction(), pw._manual):
             raise ValueError('Cannot enter atomic commit block while in manual commit mode.')
         else:
-            self._helper = self.db.savepoint_async()
+            self._helper = db.savepoint_async()
         return await self._helper.__aenter__()
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
@@ -22,7 +22,7 @@ db = PeeweeASGIPlugin(url='sqlite+async:///db.sqlite')
 
 @db.register
 class Visit(pw.Model):
-    created = pw.DateTimeField(default=dt.datetime.utcnow())
+    created = pw.DateTimeField(default=dt.datetime.utcnow)
     address = pw.CharField()
 
 
@@ -36,9 +36,10 @@ app = App()
 async def visits_json(request):
     """Store the visit and load latest 10 visits."""
     Visit.create(address=request.client[0])
+    visits = Visit.select(Visit.id, Visit.address, Visit.created).order_by(Visit.id.desc())
     return [{
-        'id': v.id, 'address': v.address, 'timestamp': round(v.created.timestamp()),
-    } for v in Visit.select().order_by(Visit.id.desc()).limit(10)]
+        'id': v['id'], 'address': v['address'], 'timestamp': round(v['created'].timestamp()),
+    } for v in visits.limit(10).dicts()]
 
 
 app = db.middleware(app)
@@ -1,4 +1,5 @@
 import peewee as pw
+from peewee import MySQLDatabase, PostgresqlDatabase, SqliteDatabase
 import pytest
 from curio.task import ContextTask
 
@@ -12,7 +13,7 @@ logger.setLevel(logging.DEBUG)
 @pytest.fixture(params=[
     'asyncio', 'trio',
     pytest.param(('curio', {'taskcls': ContextTask}), id='curio'),
-], autouse=True)
+])
 def aiolib(request):
     return request.param
 
@@ -42,28 +43,28 @@ def test_connect():
     assert isinstance(db, crdb.CockroachDatabase)
 
     db = db_url.connect('mysql+async://')
-    assert isinstance(db, pw.MySQLDatabase)
+    assert isinstance(db, MySQLDatabase)
 
     db = db_url.connect('mysql+pool+async://')
-    assert isinstance(db, pw.MySQLDatabase)
+    assert isinstance(db, MySQLDatabase)
 
     db = db_url.connect('postgres+async://')
-    assert isinstance(db, pw.PostgresqlDatabase)
+    assert isinstance(db, PostgresqlDatabase)
 
     db = db_url.connect('postgresql+async://')
-    assert isinstance(db, pw.PostgresqlDatabase)
+    assert isinstance(db, PostgresqlDatabase)
 
     db = db_url.connect('postgres+pool+async://')
-    assert isinstance(db, pw.PostgresqlDatabase)
+    assert isinstance(db, PostgresqlDatabase)
 
     db = db_url.connect('postgresql+pool+async://')
-    assert isinstance(db, pw.PostgresqlDatabase)
+    assert isinstance(db, PostgresqlDatabase)
 
     db = db_url.connect('sqlite+async://')
-    assert isinstance(db, pw.SqliteDatabase)
+    assert isinstance(db, SqliteDatabase)
 
     db = db_url.connect('sqlite+pool+async://')
-    assert isinstance(db, pw.SqliteDatabase)
+    assert isinstance(db, SqliteDatabase)
 
     assert db_url.schemes['postgresext+async']
     assert db_url.schemes['postgresext+pool+async']
@@ -91,10 +92,22 @@ async def test_basic():
         assert conn == db._state.conn
         assert conn != c1
 
+    async with db.connection_context_async() as conn:
+        assert conn is db.connection()
+        assert not db.in_transaction()
+
+    assert db.is_closed()
+
+    # Unknown context
+    from contextvars import Context
+    assert Context().run(db.is_closed)
+    assert Context().run(db.transaction_depth) == 0
+
 
 async def test_pool():
     from aiopeewee import db_url, PooledSqliteDatabaseAsync
     from aiopeewee._compat import aio_sleep, aio_wait
+    from playhouse.pool import MaxConnectionsExceeded
 
     db = db_url.connect('sqlite+pool+async:///:memory:', max_connections=3, timeout=.1)
     assert db
@@ -114,18 +127,238 @@ async def test_pool():
         await db.close_async()
         return conn
 
-    results = await aio_wait(
-        connect(),
-        connect(),
-        connect(),
-        connect(),
-        connect(),
-    )
+    results = await aio_wait(*[connect() for _ in range(5)])
 
     assert all(results)
     assert len(set(results)) == 3
     assert not db._waiters
 
+    async def hold():
+        await db.connect_async()
+        await aio_sleep(.2)
+        await db.close_async()
+
+    async def timeout():
+        await aio_sleep(.01)
+        with pytest.raises(MaxConnectionsExceeded):
+            await db.connect_async()
+
+    await aio_wait(hold(), hold(), hold(), timeout())
+    assert not db._waiters
+    assert not db._handoffs
+
+    # Without a timeout
+    db = db_url.connect('sqlite+pool+async:///:memory:', max_connections=1)
+    results = await aio_wait(*[connect() for _ in range(3)])
+    assert len(set(results)) == 1
+
+
+async def test_pool_release():
+    from aiopeewee import db_url
+    from aiopeewee._compat import aio_event, aio_sleep, aio_wait
+
+    db = db_url.connect('sqlite+pool+async:///:memory:', max_connections=2)
+    release = aio_event()
+
+    async def connect():
+        conn = await db.connect_async()
+        await release.wait()
+        await db.close_async()
+        return conn
+
+    async def driver():
+        while len(db._waiters) < 3:
+            await aio_sleep(0)
+
+        # Curio sets the events asynchronously
+        setter = release.set()
+        if setter:
+            await setter
+
+    results = await aio_wait(driver(), *[connect() for _ in range(5)])
+    conns = [conn for conn in results if conn]
+    assert len(conns) == 5
+    assert len(set(conns)) == 2
+    assert not db._waiters
+    assert not db._handoffs
+
+
+async def test_pool_handoff_errors():
+    from aiopeewee import db_url
+    from aiopeewee._compat import aio_backend, aio_sleep, aio_timeout, aio_wait
+
+    db = db_url.connect('sqlite+pool+async:///:memory:', max_connections=1)
+
+    async def close(delay):
+        await db.connect_async()
+        await aio_sleep(delay)
+        await db.close_async()
+
+    async def connect():
+        await aio_sleep(.02)
+        conn = await db.connect_async()
+        await db.close_async()
+        return conn
+
+    # Asyncio may cancel the woken waiter before it takes the connection
+    if aio_backend() == 'asyncio':
+        import asyncio
+
+        cancelled = asyncio.ensure_future(db.connect_async())
+        connected = asyncio.ensure_future(connect())
+        await db.connect_async()
+        await aio_sleep(.03)
+        await db.close_async()
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+
+        assert await aio_timeout(connected, 1)
+        assert not db._waiters
+        assert not db._handoffs
+        assert not db._in_use
+
+    # The woken waiter fails to connect
+    _connect = db._connect
+
+    def fail():
+        db._connect = _connect
+        raise pw.OperationalError('Connection failed')
+
+    async def failed():
+        await aio_sleep(.01)
+        db._connect = fail
+        with pytest.raises(pw.OperationalError):
+            await db.connect_async()
+
+    results = await aio_timeout(aio_wait(close(.03), failed(), connect()), 1)
+    assert any(results)
+    assert not db._waiters
+    assert not db._handoffs
+    assert not db._in_use
+
+
+async def test_pool_sqlite(User, tmp_path):
+    from aiopeewee import db_url
+    from aiopeewee._compat import aio_sleep, aio_wait
+
+    db = db_url.connect(f"sqlite+pool+async:///{ tmp_path / 'db.sqlite' }", max_connections=4)
+    User._meta.database = db
+    with db:
+        User.create_table()
+
+    async def write(name):
+        async with db.connection_context_async():
+            async with db.atomic_async():
+                User.create(username=name)
+                await aio_sleep(.01)
+
+    async def read():
+        async with db.connection_context_async():
+            async with db.atomic_async(None):
+                count = User.select().count()
+                await aio_sleep(.01)
+                return count
+
+    await aio_wait(write('charlie'), write('huey'), read(), read())
+    assert User.select().count() == 2
+    lock, = db._write_locks.values()
+    assert not lock.locked()
+
+
+async def test_aio_wait():
+    from aiopeewee._compat import aio_sleep, aio_wait, FIRST_COMPLETED
+
+    async def sleep(delay):
+        await aio_sleep(delay)
+        return delay
+
+    assert await aio_wait() is None
+    assert await aio_wait(sleep(0)) == [0]
+    assert await aio_wait(sleep(0), strategy=FIRST_COMPLETED) == 0
+    assert await aio_wait(sleep(.02), sleep(.01), sleep(0)) == [.02, .01, 0]
+    assert await aio_wait(sleep(.5), sleep(.01), strategy=FIRST_COMPLETED) == .01
+
+    # The others are cancelled on error
+    results = []
+
+    async def fail():
+        await aio_sleep(.01)
+        raise RuntimeError('fail')
+
+    async def append():
+        await aio_sleep(.05)
+        results.append(True)
+
+    with pytest.raises(RuntimeError):
+        await aio_wait(fail(), append())
+
+    await aio_sleep(.1)
+    assert not results
+
+
+async def test_context():
+    from aiopeewee import db_url
+    from aiopeewee._compat import aio_sleep, aio_wait
+
+    db = db_url.connect('sqlite+async:///:memory:')
+
+    async def connect():
+        async with db as conn:
+            await aio_sleep(.01)
+            assert db._state.conn is conn
+            return conn
+
+    c1, c2 = await aio_wait(connect(), connect())
+    assert c1 is not c2
+    assert db.is_closed()
+
+    async def reuse():
+        async with db as conn:
+            return conn
+
+    async with db as conn:
+        c1, c2 = await aio_wait(reuse(), reuse())
+        assert c1 is c2 is conn
+        assert not db.is_closed()
+        assert len(db._state.ctx) == 1
+
+    assert db.is_closed()
+
+    # Child tasks don't close the connection of the parent
+    async def child():
+        async with db.connection_context_async() as conn:
+            return conn
+
+    await db.connect_async()
+    conn, = await aio_wait(child())
+    c1, c2 = await aio_wait(child(), child())
+    assert c1 is c2 is conn is db.connection()
+    assert db.execute_scalar('select 42') == 42
+    await db.close_async()
+
+
+async def test_pool_unfair():
+    from aiopeewee import db_url
+    from aiopeewee._compat import aio_sleep, aio_wait
+
+    db = db_url.connect(
+        'sqlite+pool+async:///:memory:', max_connections=1, timeout=1, fair=False)
+    assert not db._fair
+
+    order = []
+
+    async def connect(name, delay):
+        await aio_sleep(delay)
+        await db.connect_async()
+        order.append(name)
+        await aio_sleep(.05)
+        await db.close_async()
+
+    await aio_wait(connect(1, 0), connect(2, .01), connect(3, .02))
+    assert order == [1, 3, 2]
+    assert not db._waiters
+
 
 async def test_sqlite():
     from aiopeewee import db_url
@@ -134,11 +367,39 @@ async def test_sqlite():
 
     async def middleware():
         async with db:
-            return db.execute_sql('select 42').fetchone()
+            return db.execute_scalar('select 42')
 
-    res, = await middleware()
+    res = await middleware()
     assert res == 42
 
+    with db:
+        assert db.execute_scalar('select ?', (42,)) == 42
+        assert db.execute_scalar('select 1 where 0') is None
+
+
+def test_sqlite_pragmas(tmp_path):
+    from aiopeewee import db_url, SqliteDatabaseAsync
+
+    db = db_url.connect(f"sqlite+async:///{ tmp_path / 'db.sqlite' }")
+    with db:
+        assert db.pragma('journal_mode') == 'wal'
+        assert db.pragma('synchronous') == 1
+
+    db = db_url.connect(
+        f"sqlite+pool+async:///{ tmp_path / 'db2.sqlite' }", pragmas={'journal_mode': 'delete'})
+    with db:
+        assert db.pragma('journal_mode') == 'delete'
+        assert db.pragma('temp_store') == 2
+
+    db = db_url.connect('sqlite+async:///:memory:')
+    with db:
+        assert db.pragma('journal_mode') == 'memory'
+
+    # Path names
+    db = SqliteDatabaseAsync(tmp_path / 'db3.sqlite')
+    with db:
+        assert db.pragma('journal_mode') == 'wal'
+
 
 async def test_transactions(User):
     from aiopeewee import db_url
@@ -172,24 +433,244 @@ async def test_transactions(User):
         txn.rollback()
 
 
-async def test_asgi():
+async def test_transactions_sqlite(User, tmp_path):
+    from aiopeewee import db_url
+    from aiopeewee._compat import aio_sleep, aio_timeout, aio_wait
+
+    db = db_url.connect(f"sqlite+async:///{ tmp_path / 'db.sqlite' }")
+    User._meta.database = db
+    with db:
+        User.create_table()
+
+    order = []
+
+    async def create(name):
+        async with db.connection_context_async():
+            async with db.atomic_async():
+                order.append(name)
+                User.create(username=name)
+                await aio_sleep(.01)
+                order.append(name)
+
+    await aio_wait(create('charlie'), create('huey'))
+    assert order in (['charlie'] * 2 + ['huey'] * 2, ['huey'] * 2 + ['charlie'] * 2)
+    assert User.select().count() == 2
+    assert db._write_locks
+
+    # Nested transactions are flattened
+    async def nested():
+        async with db.transaction_async():
+            async with db.transaction_async():
+                User.create(username='mickey')
+
+    await aio_timeout(nested(), 1)
+    assert User.select().count() == 3
+
+
+def test_transactions_sqlite_loops(User, tmp_path):
+    import asyncio
+    from aiopeewee import db_url
+
+    db = db_url.connect(f"sqlite+async:///{ tmp_path / 'db.sqlite' }")
+    User._meta.database = db
+    with db:
+        User.create_table()
+
+    async def create(name):
+        async with db.connection_context_async():
+            async with db.atomic_async():
+                User.create(username=name)
+                await asyncio.sleep(.01)
+
+    async def main():
+        await asyncio.gather(create('charlie'), create('huey'))
+
+    # The database outlives the loops
+    asyncio.run(main())
+    asyncio.run(main())
+    assert User.select().count() == 4
+
+
+async def test_executemany(User):
+    from aiopeewee import db_url
+
+    db = db_url.connect('sqlite+async:///:memory:')
+    User._meta.database = db
+
+    async with db:
+        User.create_table()
+        count = await db.executemany_async(
+            'insert into model (username) values (?)',
+            (('user%d' % n,) for n in range(500)))
+        assert count == 500
+        assert User.select().count() == 500
+
+    # The connection of the caller is kept opened
+    await db.connect_async()
+    User.create_table()
+    count = await db.executemany_async('insert into model (username) values (?)', [('huey',)])
+    assert count == 1
+    assert not db.is_closed()
+    assert User.select().count() == 1
+    await db.close_async()
+
+    # The connection opened by the call is closed
+    with pytest.raises(pw.OperationalError):
+        await db.executemany_async('insert into model (username) values (?)', [('huey',)])
+    assert db.is_closed()
+
+
+async def test_asgi(tmp_path):
     from aiopeewee import PeeweeASGIPlugin
     from asgi_tools import App
     from asgi_tools.tests import ASGITestClient
 
     app = App(debug=True)
     client = ASGITestClient(app)
-    db = PeeweeASGIPlugin(url='sqlite+async:///:memory:')
+    db = PeeweeASGIPlugin(url=f"sqlite+async:///{ tmp_path / 'db.sqlite' }")
     app.middleware(db.middleware)
 
     @app.route('/')
     async def sql(request):
-        result, = db.execute_sql(f"select { request.url.query['num'] }").fetchone()
-        return result
+        return db.execute_scalar("select ?", (int(request.url.query['num']),))
 
     res = await client.get('/', query={'num': 42})
     assert res.status_code == 200
     assert await res.json() == 42
 
+    @db.register
+    class Visit(pw.Model):
+        address = pw.CharField()
+
+    db.create_tables()
+
+    @app.route('/visits')
+    async def visits(request):
+        Visit.create(address='127.0.0.1')
+        return Visit.select().count()
+
+    res = await client.get('/visits')
+    assert await res.json() == 1
+    res = await client.get('/visits')
+    assert await res.json() == 2
+
+    await db.shutdown()
+    assert db.is_closed()
+
+
+async def test_asgi_concurrent(User, tmp_path):
+    from aiopeewee import PeeweeASGIPlugin
+    from aiopeewee._compat import aio_sleep, aio_wait
+    from asgi_tools import App
+    from asgi_tools.tests import ASGITestClient
+
+    app = App(debug=True)
+    client = ASGITestClient(app)
+    db = PeeweeASGIPlugin(url=f"sqliteext+async:///{ tmp_path / 'db.sqlite' }")
+    app.middleware(db.middleware)
+
+    db.register(User)
+    db.create_tables()
+    assert db.is_closed()
+
+    @app.route('/create')
+    async def create(request):
+        async with db.atomic_async():
+            User.create(username=request.url.query['name'])
+            await aio_sleep(.02)
+
+        return User.select().count()
+
+    @app.route('/count')
+    async def count(request):
+        await aio_sleep(.01)
+        async with db.database:
+            return User.select().count()
+
+    # The reader overlaps the open write transactions
+    results = await aio_wait(
+        client.get('/create', query={'name': 'charlie'}),
+        client.get('/create', query={'name': 'huey'}),
+        client.get('/count'),
+    )
+    assert all(res.status_code == 200 for res in results)
+    assert sorted([await res.json() for res in results]) == [0, 1, 2]
+
+    # The requests close their own connections only
+    res = await client.get('/count')
+    assert await res.json() == 2
+    res = await client.get('/count')
+    assert await res.json() == 2
+
+    await db.shutdown()
+
+
+async def test_asgi_lazy(tmp_path):
+    from aiopeewee import PeeweeASGIPlugin
+    from asgi_tools import App
+    from asgi_tools.tests import ASGITestClient
+
+    app = App(debug=True)
+    client = ASGITestClient(app)
+    db = PeeweeASGIPlugin(url=f"sqlite+async:///{ tmp_path / 'db.sqlite' }", lazy=True)
+    app.middleware(db.middleware)
+
+    @app.route('/')
+    async def sql(request):
+        if 'num' not in request.url.query:
+            return db.is_closed()
+
+        return db.execute_scalar("select ?", (int(request.url.query['num']),))
+
+    res = await client.get('/')
+    assert res.status_code == 200
+    assert await res.json() is True
+
+    res = await client.get('/', query={'num': 42})
+    assert res.status_code == 200
+    assert await res.json() == 42
+    assert db.is_closed()
+
+
+async def test_asgi_shutdown():
+    from aiopeewee import PeeweeASGIPlugin
+    from aiopeewee._compat import aio_sleep, aio_wait
+
+    db = PeeweeASGIPlugin(
+        url='sqlite+pool+async:///:memory:', connection_params={'max_connections': 1})
+
+    async def connect():
+        await db.connect_async()
+        await aio_sleep(.05)
+
+    async def shutdown():
+        await aio_sleep(.01)
+        assert db._waiters
+        await db.shutdown()
+
+    await aio_wait(connect(), connect(), shutdown())
+    assert not db._waiters
+    assert not db._handoffs
+
+
+def test_asgi_models():
+    from aiopeewee import PeeweeASGIPlugin
+
+    db = PeeweeASGIPlugin(url='sqlite+async:///:memory:')
+
+    class Author(pw.Model):
+        name = pw.CharField()
+
+    @db.register
+    class Book(pw.Model):
+        author = pw.ForeignKeyField(Author)
+
+    db.register(Author)
+    assert list(db.models) == ['book', 'author']
+
+    with db.database:
+        db.create_tables()
+        assert db.database.get_tables() == ['author', 'book']
+
 
 # TODO: transactions, context